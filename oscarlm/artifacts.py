@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+import os
+import sys
+import zlib
+import errno
+import shutil
+import socket
+import hashlib
+
+import six.moves.urllib as urllib
+
+BLOCK_SIZE = 1024 * 1024
+TEMP_INFIX = '.part-'
+
+# Directory of a content-addressed artifact cache that can be shared by several nodes (e.g. on a network filesystem)
+CACHE_DIR = os.getenv('TC_CACHE_DIR')
+
+
+class ArtifactIntegrityError(Exception):
+    pass
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise e
+
+
+def get_temp_path(path):
+    # Unique per process, also across nodes sharing a (network) file system - e.g. the cache or the models directory
+    return '%s%s%s-%d' % (path, TEMP_INFIX, socket.gethostname(), os.getpid())
+
+
+def hash_file(path, block_size=BLOCK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_artifact(url, to_path, progress=True, expected_sha256=None, block_size=BLOCK_SIZE):
+    # Streams the artifact to disk, decompressing gzip transfer encoding on the fly,
+    # and returns the SHA-256 of the (decompressed) content
+    temp_path = get_temp_path(to_path)
+    response = urllib.request.urlopen(url)
+    try:
+        headers = response.info()
+        total_size = int(headers.get('Content-Length') or 0)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if headers.get('Content-Encoding') == 'gzip' else None
+        digest = hashlib.sha256()
+        read_size = 0
+        with open(temp_path, 'wb') as to_file:
+            while True:
+                block = response.read(block_size)
+                if not block:
+                    break
+                read_size += len(block)
+                if decompressor is not None:
+                    block = decompressor.decompress(block)
+                digest.update(block)
+                to_file.write(block)
+                if progress and total_size > 0:
+                    sys.stderr.write('\rDownloading: %d%%' % (read_size * 100 // total_size))
+                    sys.stderr.flush()
+            if decompressor is not None:
+                block = decompressor.flush()
+                digest.update(block)
+                to_file.write(block)
+        if progress and total_size > 0:
+            sys.stderr.write('\n')
+        sha256 = digest.hexdigest()
+        if expected_sha256 is not None and sha256 != expected_sha256.lower():
+            raise ArtifactIntegrityError('Artifact %s has SHA-256 %s - expected %s' % (url, sha256, expected_sha256))
+        os.rename(temp_path, to_path)
+        return sha256
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.unlink(temp_path)
+        raise
+    finally:
+        response.close()
+
+
+def get_validator(url):
+    # Identifies the current version of an artifact through the URL it redirects to (e.g. the task specific
+    # URL of a taskcluster index entry) and its ETag and Last-Modified headers
+    request = urllib.request.Request(url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError:
+        # Servers not supporting HEAD requests
+        return None
+    try:
+        headers = response.info()
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return None
+        return '%s\n%s\n%s\n' % (response.geturl(), etag or '', last_modified or '')
+    finally:
+        response.close()
+
+
+class ArtifactCache(object):
+    # Layout: blobs/<sha[:2]>/<sha> holds the artifact contents, urls/<sha256 of URL> the SHA-256 of the
+    # contents last fetched from that URL followed by their validator (see get_validator). All files are
+    # written to temporary files first and atomically renamed into place, so concurrent nodes can share
+    # the cache without locking.
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.blobs_dir = os.path.join(self.root, 'blobs')
+        self.urls_dir = os.path.join(self.root, 'urls')
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+    def url_path(self, url):
+        return os.path.join(self.urls_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def lookup(self, url, expected_sha256=None, validator=None, revalidate=True):
+        # Without an expected SHA-256, an URL only resolves to the cached contents while its validator is unchanged
+        # (or to the contents last fetched from it, if it cannot be revalidated)
+        sha256 = expected_sha256.lower() if expected_sha256 is not None else None
+        if sha256 is None:
+            if revalidate and validator is None:
+                return None
+            url_path = self.url_path(url)
+            if not os.path.isfile(url_path):
+                return None
+            with open(url_path) as url_file:
+                sha256, _, cached_validator = url_file.read().partition('\n')
+            if revalidate and cached_validator != validator:
+                print('Cached %s is outdated' % url, file=sys.stderr)
+                return None
+        blob_path = self.blob_path(sha256)
+        if not os.path.isfile(blob_path):
+            return None
+        if hash_file(blob_path) != sha256:
+            print('Removing corrupted cache entry %s' % blob_path, file=sys.stderr)
+            os.unlink(blob_path)
+            return None
+        return blob_path
+
+    def fetch(self, url, progress=True, expected_sha256=None):
+        validator = None
+        revalidation_error = None
+        if expected_sha256 is None:
+            try:
+                validator = get_validator(url)
+            except (urllib.error.URLError, socket.error) as e:
+                # E.g. a refused connection or a failed DNS lookup - the server could just be unreachable from here
+                revalidation_error = e
+        blob_path = self.lookup(url, expected_sha256=expected_sha256, validator=validator,
+                                revalidate=revalidation_error is None)
+        if blob_path is not None:
+            if revalidation_error is None:
+                print('Using cached %s' % url, file=sys.stderr)
+            else:
+                print('Using cached %s without revalidation (%s)' % (url, revalidation_error), file=sys.stderr)
+            return blob_path
+        print('Downloading %s to cache %s ...' % (url, self.root), file=sys.stderr)
+        makedirs(self.blobs_dir)
+        download_path = get_temp_path(os.path.join(self.blobs_dir, 'download'))
+        sha256 = download_artifact(url, download_path, progress=progress, expected_sha256=expected_sha256)
+        blob_path = self.blob_path(sha256)
+        makedirs(os.path.dirname(blob_path))
+        os.rename(download_path, blob_path)
+        if validator is not None:
+            makedirs(self.urls_dir)
+            url_path = self.url_path(url)
+            temp_path = get_temp_path(url_path)
+            with open(temp_path, 'w') as url_file:
+                url_file.write(sha256 + '\n' + validator)
+            os.rename(temp_path, url_path)
+        return blob_path
+
+    def export(self, url, to_path, progress=True, expected_sha256=None):
+        blob_path = self.fetch(url, progress=progress, expected_sha256=expected_sha256)
+        # Copying (instead of linking) keeps permission changes on the target away from the shared blob
+        temp_path = get_temp_path(to_path)
+        shutil.copyfile(blob_path, temp_path)
+        os.rename(temp_path, to_path)
+        return to_path
@@ -0,0 +1,85 @@
+import time
+import pickle
+import random
+import argparse
+import resource
+from itertools import accumulate
+from collections import Counter
+from multiprocessing import Process, Queue
+
+from counting import WordCounter, TokenCounter
+
+# Flushing a plain Counter through pickle is how workers counted before the binary delta format
+COUNTERS = {
+    'pickled': (Counter, pickle.dumps),
+    'dict': (WordCounter, WordCounter.to_delta),
+    'compact': (TokenCounter, TokenCounter.to_delta)
+}
+
+
+def generate_lines(line_count, word_count, words_per_line, seed):
+    rng = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyzäöü'
+    words = [''.join(rng.choice(alphabet) for _ in range(rng.randint(2, 12))) for _ in range(word_count)]
+    # Zipf-like word frequencies, like in natural language
+    cum_weights = list(accumulate(1 / rank for rank in range(1, word_count + 1)))
+    return [' '.join(rng.choices(words, cum_weights=cum_weights, k=words_per_line)) for _ in range(line_count)]
+
+
+def read_lines(text_path, line_count):
+    lines = []
+    with open(text_path, encoding='utf-8') as text_file:
+        for line in text_file:
+            if len(lines) >= line_count:
+                break
+            lines.append(line.rstrip('\n'))
+    return lines
+
+
+def measure(kind, lines, results):
+    counter_type, to_delta = COUNTERS[kind]
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    counter = counter_type()
+    for line in lines:
+        counter.update(line.split())
+    count_time = time.perf_counter() - start
+    start = time.perf_counter()
+    delta = to_delta(counter)
+    flush_time = time.perf_counter() - start
+    # ru_maxrss is given in kilobytes on Linux
+    rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024
+    results.put((kind, len(counter), count_time, flush_time, len(delta) / (1024 * 1024), rss_growth))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures worker side word counting and flushing of all counters')
+    parser.add_argument('--text', default=None,
+                        help='text file to count the words of (e.g. models/en/prepared.txt) - '
+                             'a synthetic corpus is generated by default')
+    parser.add_argument('--lines', type=int, default=200000, help='number of lines to count')
+    parser.add_argument('--words', type=int, default=400000, help='number of distinct words of the synthetic corpus')
+    parser.add_argument('--words-per-line', type=int, default=10, help='words per line of the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic corpus')
+    parser.add_argument('--counters', default=','.join(COUNTERS.keys()),
+                        help='comma separated counters to measure - any of ' + ', '.join(COUNTERS.keys()))
+    args = parser.parse_args()
+    if args.text is None:
+        lines = generate_lines(args.lines, args.words, args.words_per_line, args.seed)
+    else:
+        lines = read_lines(args.text, args.lines)
+    print('{:<10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('counter', 'words', 'count s', 'flush ms', 'delta MB',
+                                                          'RSS MB'))
+    results = Queue()
+    for kind in args.counters.split(','):
+        # Every counter gets measured in a fresh process, so that their peak RSS values do not mask each other
+        p = Process(target=measure, args=(kind, lines, results))
+        p.start()
+        kind, words, count_time, flush_time, delta_size, rss_growth = results.get()
+        p.join()
+        print('{:<10} {:>10} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            kind, words, count_time, 1000 * flush_time, delta_size, rss_growth))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import unicodedata
+from collections import Counter
+
+from utils import announce
+
+# Auto alphabet mode uses an UTF-8 alphabet if the language's alphabet misses a bigger share of the text's characters
+DEFAULT_UTF8_THRESHOLD = 0.25
+USE_UTF8_KEY = 'use_utf8'
+UTF8_THRESHOLD_KEY = 'utf8_threshold'
+DROPPED_RATE_KEY = 'dropped_rate'
+
+
+class CharacterStats:
+    def __init__(self):
+        self.total = 0
+        self.dropped = Counter()
+        self.simplified = Counter()
+
+    def merge(self, other):
+        self.total += other.total
+        self.dropped += other.dropped
+        self.simplified += other.simplified
+
+
+def describe_char(c):
+    return 'U+{:04X} {!r} {}'.format(ord(c), c, unicodedata.name(c, '-'))
+
+
+def get_rate(count, total):
+    return count / total if total > 0 else 0.0
+
+
+def get_use_utf8(dropped_rate, utf8_threshold):
+    return dropped_rate > utf8_threshold
+
+
+def write_report(report_path, stats, utf8_threshold, top=20):
+    dropped = sum(stats.dropped.values())
+    simplified = sum(stats.simplified.values())
+    dropped_rate = get_rate(dropped, stats.total)
+    announce('{:.4%} of characters got dropped, {:.4%} got simplified'
+             .format(dropped_rate, get_rate(simplified, stats.total)))
+    if dropped > 0:
+        announce('Most frequently dropped characters: {}'
+                 .format(' '.join(c for c, _ in stats.dropped.most_common(top))))
+    with open(report_path, 'w', encoding='utf-8') as report_file:
+        report_file.write('{}: {}\n'.format(USE_UTF8_KEY, get_use_utf8(dropped_rate, utf8_threshold)))
+        report_file.write('{}: {}\n'.format(UTF8_THRESHOLD_KEY, utf8_threshold))
+        report_file.write('characters: {}\n'.format(stats.total))
+        report_file.write('dropped: {}\n'.format(dropped))
+        report_file.write('{}: {}\n'.format(DROPPED_RATE_KEY, dropped_rate))
+        report_file.write('simplified: {}\n'.format(simplified))
+        report_file.write('simplified_rate: {}\n'.format(get_rate(simplified, stats.total)))
+        report_file.write('\ndropped characters:\n')
+        for c, count in stats.dropped.most_common():
+            report_file.write('{} {}\n'.format(describe_char(c), count))
+        report_file.write('\nsimplified characters:\n')
+        for c, count in stats.simplified.most_common():
+            report_file.write('{} -> {!r} {}\n'.format(
+                describe_char(c), unicodedata.normalize('NFKD', c).encode('ascii', 'ignore').decode('ascii'), count))
+
+
+def read_summary(report_path):
+    summary = {}
+    with open(report_path, encoding='utf-8') as report_file:
+        for line in report_file:
+            line = line.strip()
+            if len(line) == 0:
+                break
+            key, value = line.split(': ', 1)
+            summary[key] = value
+    return summary
+
+
+def read_use_utf8(report_path, utf8_threshold):
+    # Decides again from the recorded inputs, as the threshold could have changed since the report got written
+    summary = read_summary(report_path)
+    dropped_rate = float(summary[DROPPED_RATE_KEY])
+    use_utf8 = get_use_utf8(dropped_rate, utf8_threshold)
+    announce('{:.4%} of characters got dropped by the language\'s alphabet (threshold {:.4%}) - '
+             '{} UTF-8 alphabet'.format(dropped_rate, utf8_threshold, 'using' if use_utf8 else 'not using'))
+    return use_utf8
@@ -0,0 +1,155 @@
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import six.moves.urllib as urllib
+
+from artifacts import ArtifactCache, ArtifactIntegrityError, hash_file
+from utils import announce
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    # Serves server.artifacts by path - paths starting with /gzip/ use gzip transfer encoding
+    # and paths starting with /plain/ come without ETag
+    def send_artifact(self, with_body):
+        self.server.requests.append((self.command, self.path))
+        contents = self.server.artifacts.get(self.path)
+        if contents is None:
+            self.send_error(404)
+            return
+        body = gzip.compress(contents) if self.path.startswith('/gzip/') else contents
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path.startswith('/gzip/'):
+            self.send_header('Content-Encoding', 'gzip')
+        if not self.path.startswith('/plain/'):
+            self.send_header('ETag', '"{}"'.format(hashlib.sha256(contents).hexdigest()))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_artifact(True)
+
+    def do_HEAD(self):
+        self.send_artifact(False)
+
+    def log_message(self, *args):
+        pass
+
+
+class ArtifactServer(HTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ArtifactHandler)
+        self.artifacts = {}
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def count_downloads(self):
+        return len([method for method, _ in self.requests if method == 'GET'])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def check_fetch(failures, description, cache, server, path, contents, downloads, **kwargs):
+    downloads_before = server.count_downloads()
+    try:
+        blob_path = cache.fetch(server.get_url(path), progress=False, **kwargs)
+    except Exception as e:
+        failures.append('{}: Fetching failed with "{}"'.format(description, e))
+        return
+    if read_bytes(blob_path) != contents:
+        failures.append('{}: Fetched wrong contents'.format(description))
+    if server.count_downloads() - downloads_before != downloads:
+        failures.append('{}: Expected {} downloads - got {}'
+                        .format(description, downloads, server.count_downloads() - downloads_before))
+
+
+def check_cache(work_dir):
+    failures = []
+    server = ArtifactServer()
+    cache = ArtifactCache(os.path.join(work_dir, 'cache'))
+    first, second = b'first version\n' * 1000, b'second version\n' * 1000
+    try:
+        server.artifacts['/artifact'] = first
+        check_fetch(failures, 'First fetch', cache, server, '/artifact', first, 1)
+        check_fetch(failures, 'Unchanged artifact', cache, server, '/artifact', first, 0)
+        server.artifacts['/artifact'] = second
+        check_fetch(failures, 'Changed artifact', cache, server, '/artifact', second, 1)
+        check_fetch(failures, 'Known digest', cache, server, '/artifact', second, 0,
+                    expected_sha256=hashlib.sha256(second).hexdigest())
+        blob_path = cache.blob_path(hashlib.sha256(second).hexdigest())
+        with open(blob_path, 'ab') as blob_file:
+            blob_file.write(b'corruption')
+        check_fetch(failures, 'Corrupted blob', cache, server, '/artifact', second, 1)
+        try:
+            cache.fetch(server.get_url('/artifact'), progress=False,
+                        expected_sha256=hashlib.sha256(b'never served').hexdigest())
+            failures.append('Digest mismatch: No error raised')
+        except ArtifactIntegrityError:
+            pass
+        if not os.path.isfile(blob_path) or hash_file(blob_path) != hashlib.sha256(second).hexdigest():
+            failures.append('Digest mismatch: Changed the cached blob')
+        leftovers = [name for name in os.listdir(cache.blobs_dir) if '.part-' in name]
+        if len(leftovers) > 0:
+            failures.append('Digest mismatch: Left temporary files {}'.format(', '.join(leftovers)))
+        server.artifacts['/gzip/artifact'] = first
+        check_fetch(failures, 'Gzip transfer encoding', cache, server, '/gzip/artifact', first, 1)
+        server.artifacts['/plain/artifact'] = first
+        check_fetch(failures, 'No validator', cache, server, '/plain/artifact', first, 1)
+        check_fetch(failures, 'No validator again', cache, server, '/plain/artifact', first, 1)
+        export_path = os.path.join(work_dir, 'exported')
+        cache.export(server.get_url('/artifact'), export_path, progress=False)
+        if read_bytes(export_path) != second:
+            failures.append('Export: Wrong contents')
+    finally:
+        server.stop()
+    # The stopped server refuses connections
+    check_fetch(failures, 'Unreachable server', cache, server, '/artifact', second, 0)
+    try:
+        cache.fetch(server.get_url('/never-fetched'), progress=False)
+        failures.append('Unreachable server: No error raised for an uncached artifact')
+    except urllib.error.URLError:
+        pass
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the artifact cache against a local HTTP server')
+    parser.add_argument('--keep', action='store_true', help='keeps the working directory')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix='check_artifacts_')
+    try:
+        failures = check_cache(work_dir)
+    finally:
+        if args.keep:
+            announce('Kept working directory "{}"'.format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+    if len(failures) > 0:
+        for failure in failures:
+            announce('FAILED: ' + failure)
+        sys.exit(1)
+    announce('Artifact cache works as expected')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import os
+import sys
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+from multiprocessing import Process
+
+import genlm
+import languages
+from coordinator import Coordinator, LEASE_SUFFIX, DONE_SUFFIX
+from tokenized import TokenCorpus
+from utils import announce
+
+WORDS = ['the', 'of', 'and', 'to', 'in', 'is', 'was', 'for', 'that', 'on', 'with', 'as', 'it', 'by', 'language',
+         'model', 'café', 'naïve', 'über', 'ﬁne', '3', '42', '$5', '10€', '(note)', 'x/y', '日本', '—']
+
+
+def generate_text(text_path, line_count, seed):
+    rng = random.Random(seed)
+    with open(text_path, 'wb') as text_file:
+        for _ in range(line_count):
+            if rng.random() < 0.01:
+                # Lines that are no valid UTF-8 get skipped by preparation
+                text_file.write(b'\xff\xfe broken\n')
+                continue
+            line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 40)))
+            text_file.write((line.capitalize() + '\n').encode())
+
+
+def get_paths(model_dir):
+    return [os.path.join(model_dir, name) for name in ['unprepared.txt', 'prepared.txt', 'prepared.ids', 'heldout.txt',
+                                                       'vocabulary.txt', 'characters.txt']]
+
+
+def prepare_local(model_dir):
+    genlm.LANG.model_dir = model_dir
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(genlm.prepare(*get_paths(model_dir)))
+    finally:
+        loop.close()
+
+
+def plant_lease(coordinator, name, node_id, age):
+    lease_path = coordinator.get_lease_path(name, 0)
+    with open(lease_path, 'w') as lease_file:
+        lease_file.write(node_id + '\n')
+    mtime = time.time() - age
+    os.utime(lease_path, (mtime, mtime))
+
+
+def run_node(coordinator_dir, model_dir, chunk_count, merged_by_path):
+    unprepared_txt, prepared_txt, prepared_ids, heldout_txt, vocabulary_txt, characters_txt = get_paths(model_dir)
+    genlm.prepare_chunks(coordinator_dir, unprepared_txt, chunk_count)
+    coordinator = Coordinator(coordinator_dir, lease_timeout=genlm.ARGS.lease_timeout)
+
+    def merge():
+        with open(merged_by_path, 'a') as merged_by_file:
+            merged_by_file.write(coordinator.node_id + '\n')
+        return genlm.merge_chunks(coordinator, chunk_count, prepared_txt, prepared_ids, heldout_txt,
+                                  vocabulary_txt, characters_txt)
+    coordinator.run_once('merge', merge)
+
+
+def prepare_distributed(model_dir, processes):
+    genlm.LANG.model_dir = model_dir
+    coordinator = Coordinator(os.path.join(model_dir, 'distributed-check'), lease_timeout=genlm.ARGS.lease_timeout)
+    chunk_count = max(1, math.ceil(os.path.getsize(get_paths(model_dir)[0]) / genlm.ARGS.chunk_size))
+    # Leases of a crashed node, including its half written chunk results,
+    # and a chunk lease of a node that stops sending heartbeats right away
+    crashed_age = 10 * genlm.ARGS.lease_timeout
+    plant_lease(coordinator, genlm.get_chunk_name(0), 'crashed-node', crashed_age)
+    plant_lease(coordinator, 'merge', 'crashed-node', crashed_age)
+    crashed_dir = coordinator.get_path('{}.part-crashed-node'.format(genlm.get_chunk_name(0)))
+    os.makedirs(crashed_dir)
+    with open(os.path.join(crashed_dir, 'prepared.txt'), 'w') as crashed_file:
+        crashed_file.write('half written\n')
+    plant_lease(coordinator, genlm.get_chunk_name(chunk_count - 1), 'stalled-node', 0)
+    merged_by_path = os.path.join(model_dir, 'merged-by')
+    announce('Preparing {} chunks with {} processes...'.format(chunk_count, processes))
+    node_processes = [Process(target=run_node, args=(coordinator.directory, model_dir, chunk_count, merged_by_path))
+                      for _ in range(processes)]
+    for p in node_processes:
+        p.start()
+    for p in node_processes:
+        p.join()
+    failures = ['Process {} exited with code {}'.format(p.pid, p.exitcode) for p in node_processes if p.exitcode != 0]
+    with open(merged_by_path) as merged_by_file:
+        merged_by = merged_by_file.read().split()
+    if len(merged_by) != 1:
+        failures.append('Chunks got merged {} times (by {})'.format(len(merged_by), ', '.join(merged_by)))
+    for name in [genlm.get_chunk_name(0), 'merge', genlm.get_chunk_name(chunk_count - 1)]:
+        if not os.path.isfile(coordinator.get_lease_path(name, 1)):
+            failures.append('Planted lease "{}" did not get taken over'.format(name))
+    genlm.remove_chunk_files(coordinator, chunk_count)
+    leftovers = [name for name in os.listdir(coordinator.directory)
+                 if name.startswith('chunk') and LEASE_SUFFIX not in name and not name.endswith(DONE_SUFFIX)]
+    if len(leftovers) > 0:
+        failures.append('Chunk files {} did not get removed'.format(', '.join(sorted(leftovers))))
+    return failures
+
+
+def claim_interleaved(claimer, name, interleave):
+    # Runs interleave between the claimer finding the lease free and trying to claim it
+    is_free = claimer._is_free
+
+    def is_free_interleaved(lease_path):
+        free = is_free(lease_path)
+        interleave()
+        return free
+    claimer._is_free = is_free_interleaved
+    try:
+        return claimer.try_claim(name)
+    finally:
+        claimer._is_free = is_free
+
+
+def check_lease_interleavings(work_dir):
+    directory = os.path.join(work_dir, 'interleavings')
+    slow, taker, other = [Coordinator(directory, lease_timeout=genlm.ARGS.lease_timeout) for _ in range(3)]
+    failures = []
+    abandoned_age = 10 * genlm.ARGS.lease_timeout
+    # Two processes find the same lease abandoned - the second one claims it first
+    plant_lease(slow, 'takeover', 'crashed-node', abandoned_age)
+    if claim_interleaved(other, 'takeover', lambda: taker.try_claim('takeover')) or not taker.holds('takeover'):
+        failures.append('An abandoned lease got taken over twice')
+    # A slow holder releases a lease that got taken over in the meantime
+    slow.try_claim('release')
+    lease_path = slow.get_lease_path('release', 0)
+    os.utime(lease_path, (time.time() - abandoned_age,) * 2)
+    taker.try_claim('release')
+    slow.release('release')
+    if other.try_claim('release'):
+        failures.append('Releasing a lease that got taken over freed the lease of its new holder')
+    # A slow holder completes while another process is taking over its lease
+    slow.try_claim('completion')
+    lease_path = slow.get_lease_path('completion', 0)
+    os.utime(lease_path, (time.time() - abandoned_age,) * 2)
+    if claim_interleaved(other, 'completion', lambda: slow.complete('completion')):
+        failures.append('A lease got claimed after its work got completed')
+    return failures
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_sorted_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return sorted(f.read().splitlines())
+
+
+def compare_outputs(local_dir, distributed_dir):
+    failures = []
+    for name in ['prepared.txt', 'heldout.txt']:
+        if read_bytes(os.path.join(local_dir, name)) != read_bytes(os.path.join(distributed_dir, name)):
+            failures.append('{} differs'.format(name))
+    # Order of words and characters with the same counts depends on the order in which counts got aggregated
+    for name in ['vocabulary.txt', 'characters.txt']:
+        if read_sorted_lines(os.path.join(local_dir, name)) != read_sorted_lines(os.path.join(distributed_dir, name)):
+            failures.append('{} differs'.format(name))
+    for model_dir in [local_dir, distributed_dir]:
+        # Token IDs keep words, but not the spaces between them
+        with open(os.path.join(model_dir, 'prepared.txt'), encoding='utf-8') as prepared_file:
+            words = [' '.join(line.split()) for line in prepared_file]
+        with TokenCorpus(os.path.join(model_dir, 'prepared.ids')) as corpus:
+            if list(corpus.iter_text()) != words:
+                failures.append('Token IDs of "{}" do not match its prepared text'.format(model_dir))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks that distributed preparation with several local processes '
+                                                 '(and abandoned leases) gives the same results as local preparation')
+    parser.add_argument('--language', choices=languages.LANGUAGE_CODES, default='en',
+                        help='language to prepare the text with')
+    parser.add_argument('--text', default=None,
+                        help='unprepared text file to use - a synthetic one gets generated by default')
+    parser.add_argument('--lines', type=int, default=20000, help='number of lines of the synthetic text')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic text')
+    parser.add_argument('--processes', type=int, default=4, help='number of distributed preparation processes')
+    parser.add_argument('--workers', type=int, default=3, help='number of local preparation workers')
+    parser.add_argument('--chunk-size', type=str, default='64k', help='chunk size of distributed preparation')
+    parser.add_argument('--lease-timeout', type=int, default=3,
+                        help='seconds after which leases of the stalled node get taken over')
+    parser.add_argument('--keep', action='store_true', help='keeps the working directory')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix='check_distributed_')
+    failures = []
+    try:
+        languages.MODELS_DIR = work_dir
+        genlm.LANG = languages.get_language(args.language)
+        # A vocabulary size above the number of distinct words keeps aggregation from pruning counts
+        genlm.ARGS = genlm.parse_args([args.language,
+                                       '--workers', str(args.workers),
+                                       '--block-size', '1M',
+                                       '--vocabulary-size', '10000000',
+                                       '--token-ids',
+                                       '--heldout-every', '7',
+                                       '--chunk-size', args.chunk_size,
+                                       '--lease-timeout', str(args.lease_timeout)])
+        local_dir = os.path.join(work_dir, 'local')
+        distributed_dir = os.path.join(work_dir, 'distributed')
+        for model_dir in [local_dir, distributed_dir]:
+            os.makedirs(model_dir)
+        unprepared_txt = get_paths(local_dir)[0]
+        if args.text is None:
+            generate_text(unprepared_txt, args.lines, args.seed)
+        else:
+            shutil.copyfile(args.text, unprepared_txt)
+        shutil.copyfile(unprepared_txt, get_paths(distributed_dir)[0])
+        prepare_local(local_dir)
+        failures.extend(check_lease_interleavings(work_dir))
+        failures.extend(prepare_distributed(distributed_dir, args.processes))
+        if len(failures) == 0:
+            failures.extend(compare_outputs(local_dir, distributed_dir))
+    finally:
+        if args.keep:
+            announce('Kept working directory "{}"'.format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+    if len(failures) > 0:
+        for failure in failures:
+            announce('FAILED: ' + failure)
+        sys.exit(1)
+    announce('Distributed preparation matches local preparation')
+
+
+if __name__ == '__main__':
+    main()
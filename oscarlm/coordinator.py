@@ -0,0 +1,128 @@
+import os
+import time
+import socket
+import threading
+
+from utils import announce, get_temp_path
+
+LEASE_SUFFIX = '.lease'
+DONE_SUFFIX = '.done'
+RELEASED_SUFFIX = '.released'
+DEFAULT_LEASE_TIMEOUT = 600
+POLL_INTERVAL = 1
+
+
+def get_node_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class Coordinator:
+    # Coordinates processes on nodes sharing a (network) file system through lease and done files in one directory.
+    # Every claim of a name exclusively creates the next generation of its lease file, which is kept alive
+    # by a heartbeat thread touching it. A generation is only ever created once and lease files are never removed,
+    # so of all processes trying to claim a released or abandoned (not touched for lease_timeout seconds) lease,
+    # exactly one succeeds. As a takeover can still race with a slow but alive holder, work done under a lease
+    # has to be idempotent and get committed through atomic renames before being marked as done.
+    def __init__(self, directory, lease_timeout=DEFAULT_LEASE_TIMEOUT, poll_interval=POLL_INTERVAL):
+        self.directory = directory
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.node_id = get_node_id()
+        self.held = {}
+        self.lock = threading.Lock()
+        self.heartbeat = None
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, name, suffix=''):
+        return os.path.join(self.directory, name + suffix)
+
+    def get_lease_path(self, name, generation):
+        return self.get_path(name, '{}.{}'.format(LEASE_SUFFIX, generation))
+
+    def _beat(self):
+        while True:
+            time.sleep(self.lease_timeout / 4)
+            with self.lock:
+                for name, generation in self.held.items():
+                    try:
+                        os.utime(self.get_lease_path(name, generation))
+                    except OSError as ex:
+                        # E.g. a hiccup of the network file system - the next beat could succeed again
+                        announce('Coordinator {}: Failed to renew lease "{}" - {}'.format(self.node_id, name, ex))
+
+    def _get_generation(self, name):
+        # Generations are created in order and never removed - -1 if the lease was never claimed
+        generation = -1
+        while os.path.exists(self.get_lease_path(name, generation + 1)):
+            generation += 1
+        return generation
+
+    def _is_free(self, lease_path):
+        if os.path.exists(lease_path + RELEASED_SUFFIX):
+            return True
+        return time.time() - os.path.getmtime(lease_path) > self.lease_timeout
+
+    def is_done(self, name):
+        return os.path.isfile(self.get_path(name, DONE_SUFFIX))
+
+    def get_result(self, name):
+        with open(self.get_path(name, DONE_SUFFIX)) as done_file:
+            return done_file.read().split()[1] == 'True'
+
+    def holds(self, name):
+        return name in self.held
+
+    def try_claim(self, name):
+        if self.is_done(name):
+            return False
+        generation = self._get_generation(name)
+        if generation >= 0 and not self._is_free(self.get_lease_path(name, generation)):
+            return False
+        generation += 1
+        try:
+            fd = os.open(self.get_lease_path(name, generation), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another process claimed this generation first
+            return False
+        with os.fdopen(fd, 'w') as lease_file:
+            lease_file.write(self.node_id + '\n')
+        with self.lock:
+            self.held[name] = generation
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self._beat, daemon=True)
+                self.heartbeat.start()
+        if self.is_done(name):
+            # The previous holder completed while this process was claiming
+            self.release(name)
+            return False
+        return True
+
+    def release(self, name):
+        # Only marks the generation of this process as released - leases taken over by others stay untouched
+        with self.lock:
+            generation = self.held.pop(name, None)
+        if generation is not None:
+            open(self.get_lease_path(name, generation) + RELEASED_SUFFIX, 'w').close()
+
+    def complete(self, name, result=True):
+        done_path = self.get_path(name, DONE_SUFFIX)
+        temp_path = get_temp_path(done_path)
+        with open(temp_path, 'w') as done_file:
+            done_file.write('{} {}\n'.format(self.node_id, result))
+        os.rename(temp_path, done_path)
+        self.release(name)
+
+    def run_once(self, name, func):
+        # Runs func on exactly one node - all other nodes wait for it and get its (boolean) result
+        while True:
+            if self.is_done(name):
+                return self.get_result(name)
+            if self.try_claim(name):
+                try:
+                    result = func()
+                except BaseException:
+                    self.release(name)
+                    raise
+                self.complete(name, result=bool(result))
+                return bool(result)
+            time.sleep(self.poll_interval)
@@ -0,0 +1,127 @@
+import zlib
+import struct
+from array import array
+from collections import Counter
+
+# Worker side word counting without a Python object per distinct word (opt-in, see --compact-counting):
+# words are UTF-8 encoded into a shared byte arena and found through an open-addressing table of entry indices.
+EMPTY_SLOT = -1
+INITIAL_CAPACITY = 1 << 16
+MAX_LOAD_FACTOR = 0.5
+# Words never contain whitespace (they are split by it), so a line break can terminate them in the arena
+SEPARATOR = '\n'
+ENCODED_SEPARATOR = SEPARATOR.encode()
+# Counts of a delta use the smallest of these unsigned types that holds their maximum. As most words are rare,
+# most counts are small, and their zero bytes compress well even at the fastest compression level.
+COUNT_TYPES = ['B', 'H', 'I', 'Q']
+COUNTS_COMPRESSION_LEVEL = 1
+DELTA_HEADER = struct.Struct('<QcQQ')
+
+
+def get_count_type(max_count):
+    for typecode in COUNT_TYPES:
+        if max_count < 1 << (8 * array(typecode).itemsize):
+            return typecode
+    raise OverflowError('Count {} exceeds all count types'.format(max_count))
+
+
+def pack_delta(counts, arena):
+    # Delta layout: header (number of entries, count type, compressed counts size, arena size),
+    # compressed counts, arena of separated words
+    compressed = zlib.compress(counts.tobytes(), COUNTS_COMPRESSION_LEVEL)
+    header = DELTA_HEADER.pack(len(counts), counts.typecode.encode(), len(compressed), len(arena))
+    return b''.join([header, compressed, arena])
+
+
+class WordCounter(Counter):
+    # Default worker side counter - Counter.update() counts in C, which is faster than TokenCounter
+    # at the price of a str object per distinct word
+    def to_delta(self):
+        counts = array(get_count_type(max(self.values(), default=0)), self.values())
+        return pack_delta(counts, SEPARATOR.join(self.keys()).encode())
+
+
+class TokenCounter:
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.mask = capacity - 1
+        self.slots = array('i', [EMPTY_SLOT]) * capacity
+        self.hashes = array('q')
+        self.counts = array('Q')
+        self.offsets = array('I', [0])
+        self.arena = bytearray()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, word, count=1):
+        self.update((word,), count=count)
+
+    def update(self, words, count=1):
+        # Every word gets encoded once - as arena entries end with a separator, a word matches an entry
+        # if the arena continues with the encoded word and the separator at the entry's offset
+        slots, hashes, counts, offsets, arena, mask = \
+            self.slots, self.hashes, self.counts, self.offsets, self.arena, self.mask
+        for word in words:
+            word_hash = hash(word)
+            encoded = (word + SEPARATOR).encode()
+            slot = word_hash & mask
+            entry = slots[slot]
+            while entry != EMPTY_SLOT:
+                if hashes[entry] == word_hash and arena.startswith(encoded, offsets[entry]):
+                    counts[entry] += count
+                    break
+                slot = (slot + 1) & mask
+                entry = slots[slot]
+            else:
+                slots[slot] = len(hashes)
+                hashes.append(word_hash)
+                counts.append(count)
+                arena += encoded
+                offsets.append(len(arena))
+                if len(hashes) > MAX_LOAD_FACTOR * len(slots):
+                    self._resize(2 * len(slots))
+                    slots, mask = self.slots, self.mask
+
+    def _resize(self, capacity):
+        mask = capacity - 1
+        slots = array('i', [EMPTY_SLOT]) * capacity
+        for entry, word_hash in enumerate(self.hashes):
+            slot = word_hash & mask
+            while slots[slot] != EMPTY_SLOT:
+                slot = (slot + 1) & mask
+            slots[slot] = entry
+        self.mask = mask
+        self.slots = slots
+
+    def clear(self):
+        # Keeps the grown table, as the next block of text will most likely need the same capacity
+        self.slots = array('i', [EMPTY_SLOT]) * len(self.slots)
+        self.hashes = array('q')
+        self.counts = array('Q')
+        self.offsets = array('I', [0])
+        self.arena = bytearray()
+
+    def items(self):
+        offsets, arena = self.offsets, self.arena
+        for entry, count in enumerate(self.counts):
+            yield arena[offsets[entry]:offsets[entry + 1] - 1].decode(), count
+
+    def to_delta(self):
+        counts = self.counts
+        typecode = get_count_type(max(counts, default=0))
+        if typecode != counts.typecode:
+            counts = array(typecode, counts)
+        # Leaves out the separator after the last word
+        return pack_delta(counts, bytes(memoryview(self.arena)[:-1]))
+
+
+def iter_delta(delta):
+    entries, typecode, compressed_size, arena_size = DELTA_HEADER.unpack_from(delta)
+    if entries == 0:
+        return
+    position = DELTA_HEADER.size
+    counts = array(typecode.decode())
+    counts.frombytes(zlib.decompress(delta[position:position + compressed_size]))
+    position += compressed_size
+    words = str(memoryview(delta)[position:position + arena_size], 'utf-8').split(SEPARATOR)
+    yield from zip(words, counts)
@@ -0,0 +1,113 @@
+import time
+import math
+import signal
+import argparse
+from itertools import islice
+from multiprocessing import Pool
+
+from utils import announce, log_progress
+
+MODEL = None
+
+
+def load_model(lm_path):
+    global MODEL
+    import kenlm
+    MODEL = kenlm.Model(lm_path)
+
+
+def ignore_interrupts():
+    # Interrupts are handled by the parent process - otherwise the pool would replace interrupted workers and hang
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def evaluate_batch(lines):
+    log_prob = 0.0
+    tokens = 0
+    oovs = 0
+    latencies = []
+    for line in lines:
+        start = time.perf_counter()
+        scores = list(MODEL.full_scores(line, bos=True, eos=True))
+        latencies.append(time.perf_counter() - start)
+        for prob, _, oov in scores:
+            log_prob += prob
+            oovs += oov
+        tokens += len(scores)
+    return len(lines), log_prob, tokens, oovs, latencies
+
+
+def read_batches(text_path, batch_size, max_lines=None):
+    with open(text_path, encoding='utf-8') as text_file:
+        lines = (line.rstrip('\n') for line in text_file)
+        if max_lines is not None:
+            lines = islice(lines, max_lines)
+        while True:
+            batch = list(islice(lines, batch_size))
+            if len(batch) == 0:
+                return
+            yield batch
+
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(math.ceil(p / 100 * len(sorted_values))) - 1)]
+
+
+def evaluate(lm_path, text_path, report_path, workers=1, batch_size=1000, max_lines=None):
+    announce('Evaluating "{}" on "{}" with {} workers...'.format(lm_path, text_path, workers))
+    # Loading the model before forking lets errors surface right away - failing worker initializers would just get
+    # replaced by the pool over and over again. Forked workers also share the model's memory.
+    load_model(lm_path)
+    sentences = tokens = oovs = 0
+    log_prob = 0.0
+    latencies = []
+    start = time.perf_counter()
+    with Pool(workers, initializer=ignore_interrupts) as pool:
+        batches = pool.imap_unordered(evaluate_batch, read_batches(text_path, batch_size, max_lines=max_lines))
+        for batch_result in log_progress(batches, value_getter=lambda r: r[0], format='{:.0f} sentences'):
+            batch_sentences, batch_log_prob, batch_tokens, batch_oovs, batch_latencies = batch_result
+            sentences += batch_sentences
+            log_prob += batch_log_prob
+            tokens += batch_tokens
+            oovs += batch_oovs
+            latencies.extend(batch_latencies)
+    duration = time.perf_counter() - start
+    latencies.sort()
+    # Token counts include one end-of-sentence token per sentence (like KenLM's query tool)
+    words = tokens - sentences
+    report = [
+        ('sentences', sentences),
+        ('words', words),
+        ('perplexity', math.pow(10.0, -log_prob / tokens) if tokens > 0 else float('nan')),
+        ('oov_rate', oovs / words if words > 0 else 0.0),
+        ('sentences_per_second', sentences / duration if duration > 0 else 0.0),
+        ('words_per_second', words / duration if duration > 0 else 0.0),
+        ('latency_mean_ms', 1000 * sum(latencies) / len(latencies) if len(latencies) > 0 else 0.0),
+        ('latency_p50_ms', 1000 * percentile(latencies, 50)),
+        ('latency_p99_ms', 1000 * percentile(latencies, 99))
+    ]
+    with open(report_path, 'w') as report_file:
+        for key, value in report:
+            line = '{}: {}'.format(key, value)
+            announce(line)
+            report_file.write(line + '\n')
+    return dict(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluates a KenLM model on held-out text')
+    parser.add_argument('lm', help='path to the (binary) language model')
+    parser.add_argument('text', help='path to the held-out text file')
+    parser.add_argument('report', help='path of the evaluation report to write')
+    parser.add_argument('--workers', type=int, default=1, help='number of evaluation processes')
+    parser.add_argument('--batch-size', type=int, default=1000, help='number of lines per evaluation batch')
+    parser.add_argument('--max-lines', type=int, default=None, help='maximum number of lines to evaluate')
+    args = parser.parse_args()
+    evaluate(args.lm, args.text, args.report,
+             workers=args.workers, batch_size=args.batch_size, max_lines=args.max_lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,78 +2,282 @@
 import os
 import sys
 import math
+import time
+import zlib
+import pickle
 import struct
 import shutil
 import argparse
-import subprocess
 
 from collections import Counter
+from functools import partial
 from multiprocessing import Process, Queue
 from languages import LANGUAGE_CODES, get_language
-from utils import maybe_download, maybe_ungzip, join_files, section, log_progress, announce, parse_file_size
+from utils import maybe_download, maybe_ungzip, join_files, log_progress, announce, parse_file_size, get_temp_path, \
+    remove_temp_file, TEMP_INFIX
+from tokenized import TokenWriter, merge_token_partials, get_index_path, get_words_path, get_tables_path
+from scheduler import Stage, PipelineStopped, run_stages, run_blocking, check_call
+from counting import WordCounter, TokenCounter, iter_delta
+from characters import CharacterStats, DEFAULT_UTF8_THRESHOLD, write_report, read_use_utf8
+from coordinator import Coordinator
 
 STOP_TOKEN = False
+COUNTS_HEADER = struct.Struct('<Q')
+PIPELINE = 'pipeline'
+# Settings that have to be the same on all nodes of a distributed run, as they determine chunks and merged results
+# Settings that prepared files depend on, beyond the presence of those files
+PREPARATION_SETTINGS = ['heldout_every']
+DISTRIBUTED_SETTINGS = ['chunk_size', 'token_ids', 'vocabulary_size', 'keep_factor'] + PREPARATION_SETTINGS
 
 SW_DIR = os.getenv('SW_DIR', 'dependencies')
 KENLM_BIN = SW_DIR + '/kenlm/build/bin'
 DEEPSPEECH_BIN = SW_DIR + '/deepspeech'
+EVALUATE_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluate.py')
 
 
 def get_partial_path(index):
     return os.path.join(LANG.model_dir, 'prepared.txt.partial{}'.format(index))
 
 
+def get_partial_ids_path(index):
+    return os.path.join(LANG.model_dir, 'prepared.ids.partial{}'.format(index))
+
+
+def get_partial_heldout_path(index):
+    return os.path.join(LANG.model_dir, 'heldout.txt.partial{}'.format(index))
+
+
+def get_chunk_name(chunk):
+    return 'chunk{}'.format(chunk)
+
+
+def get_chunk_path(coordinator, chunk, name):
+    return coordinator.get_path('{}.{}'.format(get_chunk_name(chunk), name))
+
+
+def is_heldout(line):
+    # Selecting by checksum (instead of line number) keeps held-out data independent of how the text got split
+    # among workers and chunks, and keeps duplicates of a line on the same side.
+    # The empty line (checksum 0) always stays in the training data.
+    return zlib.crc32(line.encode()) % ARGS.heldout_every == ARGS.heldout_every - 1
+
+
+def prepare_range(unprepared_txt, start, end, partial_txt, partial_ids, partial_heldout, flush):
+    counter = TokenCounter() if ARGS.compact_counting else WordCounter()
+    char_stats = CharacterStats()
+    token_writer = TokenWriter(partial_ids) if ARGS.token_ids else None
+    heldout_file = open(partial_heldout, 'w') if ARGS.heldout_every > 0 else None
+    with open(unprepared_txt, 'rb', buffering=ARGS.block_size) as unprepared_file, \
+            open(partial_txt, 'w', buffering=ARGS.block_size) as partial_file:
+        if start > 0:
+            # The line overlapping the range start belongs to the previous range
+            unprepared_file.seek(start - 1)
+            unprepared_file.readline()
+        pos = old_pos = unprepared_file.tell()
+        while pos < end:
+            line = unprepared_file.readline()
+            pos = unprepared_file.tell()
+            try:
+                line = line.decode()
+            except UnicodeDecodeError:
+                continue
+            lines = LANG.clean(line, stats=char_stats)
+            for line in lines:
+                if heldout_file is not None and is_heldout(line):
+                    heldout_file.write(line + '\n')
+                    continue
+                words = line.split()
+                counter.update(words)
+                partial_file.write(line + '\n')
+                if token_writer is not None:
+                    token_writer.write_line(words)
+            if len(counter) > ARGS.vocabulary_size or pos >= end:
+                flush(counter.to_delta(), char_stats, pos - old_pos)
+                old_pos = pos
+                counter.clear()
+                char_stats = CharacterStats()
+                if token_writer is not None:
+                    token_writer.flush_ids()
+        if pos > old_pos or len(counter) > 0:
+            flush(counter.to_delta(), char_stats, pos - old_pos)
+    if token_writer is not None:
+        token_writer.close()
+    if heldout_file is not None:
+        heldout_file.close()
+
+
 def count_words(index, counters):
     try:
-        counter = Counter()
         unprepared_txt = os.path.join(LANG.model_dir, 'unprepared.txt')
         file_size = os.path.getsize(unprepared_txt)
         block_size = math.ceil(file_size / ARGS.workers)
         start = index * block_size
         end = min(file_size, start + block_size)
-        with open(unprepared_txt, 'rb', buffering=ARGS.block_size) as unprepared_file, \
-                open(get_partial_path(index), 'w', buffering=ARGS.block_size) as partial_file:
-            pos = old_pos = start
-            unprepared_file.seek(start)
-            first = True
-            while pos < end:
-                line = unprepared_file.readline()
-                pos = unprepared_file.tell()
-                if index > 0 and first:
-                    first = False
-                    continue
-                try:
-                    line = line.decode()
-                except UnicodeDecodeError:
-                    continue
-                lines = LANG.clean(line)
-                for line in lines:
-                    for word in line.split():
-                        counter[word] += 1
-                    partial_file.write(line + '\n')
-                if len(counter.keys()) > ARGS.vocabulary_size or pos >= end:
-                    counters.put((counter, pos - old_pos))
-                    old_pos = pos
-                    counter = Counter()
+        prepare_range(unprepared_txt, start, end,
+                      get_partial_path(index), get_partial_ids_path(index), get_partial_heldout_path(index),
+                      lambda delta, char_stats, read_bytes: counters.put((delta, char_stats, read_bytes)))
     except Exception as ex:
         announce('Shard worker {}: Error - {}'.format(index, ex))
 
 
-def aggregate_counters(vocabulary_txt, source_bytes, counters):
+def add_delta(overall_counter, delta):
+    for word, count in iter_delta(delta):
+        overall_counter[word] += count
+    if len(overall_counter.keys()) > ARGS.keep_factor * ARGS.vocabulary_size:
+        overall_counter = Counter(overall_counter.most_common(ARGS.vocabulary_size))
+    return overall_counter
+
+
+def write_vocabulary(vocabulary_txt, characters_txt, overall_counter, overall_char_stats):
+    vocabulary = [str(word) for word, count in overall_counter.most_common(ARGS.vocabulary_size)]
+    with open(vocabulary_txt, 'w') as vocabulary_file:
+        vocabulary_file.write('\n'.join(vocabulary))
+    write_report(characters_txt, overall_char_stats, ARGS.utf8_threshold)
+
+
+def aggregate_counters(vocabulary_txt, characters_txt, source_bytes, counters):
     overall_counter = Counter()
+    overall_char_stats = CharacterStats()
     progress_indicator = log_progress(total=source_bytes, format='bytes')
     while True:
         counter_and_read_bytes = counters.get()
         if counter_and_read_bytes == STOP_TOKEN:
-            with open(vocabulary_txt, 'w') as vocabulary_file:
-                vocabulary_file.write('\n'.join(str(word) for word, count in overall_counter.most_common(ARGS.vocabulary_size)))
             progress_indicator.end()
+            write_vocabulary(vocabulary_txt, characters_txt, overall_counter, overall_char_stats)
             return
-        counter, read_bytes = counter_and_read_bytes
-        overall_counter += counter
+        delta, char_stats, read_bytes = counter_and_read_bytes
+        overall_char_stats.merge(char_stats)
+        overall_counter = add_delta(overall_counter, delta)
         progress_indicator.increment(value_difference=read_bytes)
-        if len(overall_counter.keys()) > ARGS.keep_factor * ARGS.vocabulary_size:
-            overall_counter = Counter(overall_counter.most_common(ARGS.vocabulary_size))
+
+
+def prepare_chunk(coordinator, unprepared_txt, chunk):
+    # Chunk results are written to a node specific directory and then moved into place,
+    # so that a chunk being prepared twice (after a lease takeover) is harmless
+    temp_dir = get_temp_path(coordinator.get_path(get_chunk_name(chunk)))
+    os.makedirs(temp_dir, exist_ok=True)
+    file_size = os.path.getsize(unprepared_txt)
+    start = chunk * ARGS.chunk_size
+    end = min(file_size, start + ARGS.chunk_size)
+    chunk_char_stats = CharacterStats()
+    with open(os.path.join(temp_dir, 'counts'), 'wb') as counts_file:
+        def flush(delta, char_stats, read_bytes):
+            counts_file.write(COUNTS_HEADER.pack(len(delta)))
+            counts_file.write(delta)
+            chunk_char_stats.merge(char_stats)
+        prepare_range(unprepared_txt, start, end,
+                      os.path.join(temp_dir, 'prepared.txt'),
+                      os.path.join(temp_dir, 'prepared.ids'),
+                      os.path.join(temp_dir, 'heldout.txt'),
+                      flush)
+    with open(os.path.join(temp_dir, 'chars'), 'wb') as chars_file:
+        pickle.dump(chunk_char_stats, chars_file)
+    for name in os.listdir(temp_dir):
+        os.rename(os.path.join(temp_dir, name), get_chunk_path(coordinator, chunk, name))
+    os.rmdir(temp_dir)
+
+
+def prepare_chunks(coordinator_dir, unprepared_txt, chunk_count):
+    coordinator = Coordinator(coordinator_dir, lease_timeout=ARGS.lease_timeout)
+    pending = list(range(chunk_count))
+    while len(pending) > 0:
+        for chunk in pending:
+            if coordinator.try_claim(get_chunk_name(chunk)):
+                announce('Worker {}: Preparing chunk {} of {}...'.format(coordinator.node_id, chunk + 1, chunk_count))
+                try:
+                    prepare_chunk(coordinator, unprepared_txt, chunk)
+                except BaseException:
+                    coordinator.release(get_chunk_name(chunk))
+                    raise
+                coordinator.complete(get_chunk_name(chunk))
+        # Waiting for chunks of other workers, as their leases could become stale
+        pending = [chunk for chunk in pending if not coordinator.is_done(get_chunk_name(chunk))]
+        if len(pending) > 0:
+            time.sleep(coordinator.poll_interval)
+
+
+def merge_chunks(coordinator, chunk_count, prepared_txt, prepared_ids, heldout_txt, vocabulary_txt, characters_txt):
+    overall_counter = Counter()
+    overall_char_stats = CharacterStats()
+    announce('Merging counts of {} chunks...'.format(chunk_count))
+    for chunk in log_progress(range(chunk_count), format='{:.0f} chunks'):
+        with open(get_chunk_path(coordinator, chunk, 'counts'), 'rb') as counts_file:
+            for header in iter(partial(counts_file.read, COUNTS_HEADER.size), b''):
+                delta = counts_file.read(COUNTS_HEADER.unpack(header)[0])
+                overall_counter = add_delta(overall_counter, delta)
+        with open(get_chunk_path(coordinator, chunk, 'chars'), 'rb') as chars_file:
+            overall_char_stats.merge(pickle.load(chars_file))
+    # A slow node and a node that took over its merge lease could both be merging (like with chunks),
+    # so every node writes to its own temporary files, which get moved into place at the end
+    temp_paths = list(map(get_temp_path, [vocabulary_txt, characters_txt, prepared_txt, prepared_ids, heldout_txt]))
+    temp_vocabulary_txt, temp_characters_txt, temp_prepared_txt, temp_prepared_ids, temp_heldout_txt = temp_paths
+    renames = [(temp_vocabulary_txt, vocabulary_txt), (temp_characters_txt, characters_txt),
+               (temp_prepared_txt, prepared_txt)]
+    if ARGS.token_ids:
+        renames.extend([(temp_prepared_ids, prepared_ids),
+                        (get_index_path(temp_prepared_ids), get_index_path(prepared_ids)),
+                        (get_words_path(temp_prepared_ids), get_words_path(prepared_ids))])
+    if ARGS.heldout_every > 0:
+        renames.append((temp_heldout_txt, heldout_txt))
+    try:
+        write_vocabulary(temp_vocabulary_txt, temp_characters_txt, overall_counter, overall_char_stats)
+        chunks = range(chunk_count)
+        join_partials([get_chunk_path(coordinator, chunk, 'prepared.txt') for chunk in chunks],
+                      [get_chunk_path(coordinator, chunk, 'prepared.ids') for chunk in chunks],
+                      [get_chunk_path(coordinator, chunk, 'heldout.txt') for chunk in chunks],
+                      temp_prepared_txt, temp_prepared_ids, temp_heldout_txt, temp_vocabulary_txt)
+        for temp_path, path in renames:
+            os.rename(temp_path, path)
+    except BaseException:
+        for temp_path, _ in renames:
+            remove_temp_file(temp_path)
+        raise
+    return True
+
+
+def remove_chunk_files(coordinator, chunk_count):
+    for chunk in range(chunk_count):
+        for name in ['prepared.txt', 'prepared.ids', 'heldout.txt', 'counts', 'chars']:
+            path = get_chunk_path(coordinator, chunk, name)
+            for path in [path, get_index_path(path), get_words_path(path), get_tables_path(path)]:
+                if os.path.isfile(path):
+                    os.unlink(path)
+    # Result directories of nodes that crashed while preparing a chunk or whose chunk lease got taken over
+    temp_prefixes = tuple(get_chunk_name(chunk) + TEMP_INFIX for chunk in range(chunk_count))
+    for name in os.listdir(coordinator.directory):
+        if name.startswith(temp_prefixes):
+            shutil.rmtree(coordinator.get_path(name), ignore_errors=True)
+
+
+def write_settings(settings_path, names):
+    temp_path = get_temp_path(settings_path)
+    with open(temp_path, 'w') as settings_file:
+        for name in names:
+            settings_file.write('{}: {}\n'.format(name, getattr(ARGS, name)))
+    os.rename(temp_path, settings_path)
+    return True
+
+
+def read_settings(settings_path):
+    with open(settings_path) as settings_file:
+        return dict(line.rstrip('\n').split(': ', 1) for line in settings_file)
+
+
+def get_setting_mismatches(recorded, names):
+    return [name for name in names if recorded.get(name) != str(getattr(ARGS, name))]
+
+
+def check_settings(coordinator):
+    # The first node records its settings - all others have to use the same ones
+    settings_path = coordinator.get_path('settings.txt')
+    coordinator.run_once('settings', partial(write_settings, settings_path, DISTRIBUTED_SETTINGS))
+    recorded = read_settings(settings_path)
+    mismatches = get_setting_mismatches(recorded, DISTRIBUTED_SETTINGS)
+    if len(mismatches) > 0:
+        for name in mismatches:
+            announce('Setting "{}" is {} - other nodes of distributed run "{}" use {}'
+                     .format(name, getattr(ARGS, name), ARGS.distributed, recorded.get(name)))
+        sys.exit(1)
 
 
 def get_serialized_utf8_alphabet():
@@ -86,161 +290,330 @@ def get_serialized_utf8_alphabet():
     return bytes(res)
 
 
+def join_partials(text_partials, ids_partials, heldout_partials, prepared_txt, prepared_ids, heldout_txt, vocabulary_txt):
+    join_files(text_partials, prepared_txt)
+    if ARGS.token_ids:
+        merge_token_partials(ids_partials, vocabulary_txt, prepared_ids)
+    if ARGS.heldout_every > 0:
+        join_files(heldout_partials, heldout_txt)
+
+
+def join_local_partials(prepared_txt, prepared_ids, heldout_txt, vocabulary_txt):
+    text_partials = list(map(lambda i: get_partial_path(i), range(ARGS.workers)))
+    ids_partials = list(map(lambda i: get_partial_ids_path(i), range(ARGS.workers)))
+    heldout_partials = list(map(lambda i: get_partial_heldout_path(i), range(ARGS.workers)))
+    join_partials(text_partials, ids_partials, heldout_partials, prepared_txt, prepared_ids, heldout_txt, vocabulary_txt)
+    for partial in text_partials:
+        os.unlink(partial)
+    if ARGS.token_ids:
+        for partial in ids_partials:
+            os.unlink(partial)
+            os.unlink(get_index_path(partial))
+            os.unlink(get_words_path(partial))
+            os.unlink(get_tables_path(partial))
+    if ARGS.heldout_every > 0:
+        for partial in heldout_partials:
+            os.unlink(partial)
+
+
+async def prepare(unprepared_txt, prepared_txt, prepared_ids, heldout_txt, vocabulary_txt, characters_txt):
+    announce('Preparing {} shards of "{}"...'.format(ARGS.workers, unprepared_txt))
+    counters = Queue(ARGS.workers)
+    source_bytes = os.path.getsize(unprepared_txt)
+    # Processes have to be started from the event loop thread - forking from executor threads is not reliable
+    aggregator_process = Process(target=aggregate_counters,
+                                 args=(vocabulary_txt, characters_txt, source_bytes, counters))
+    aggregator_process.start()
+    counter_processes = list(map(lambda index: Process(target=count_words, args=(index, counters)),
+                                 range(ARGS.workers)))
+    try:
+        for p in counter_processes:
+            p.start()
+        for p in counter_processes:
+            await run_blocking(p.join)
+        # Workers report their own errors - a non-zero exit code means they got interrupted or killed
+        if any(p.exitcode != 0 for p in counter_processes):
+            raise RuntimeError('Preparation got interrupted')
+        counters.put(STOP_TOKEN)
+        await run_blocking(aggregator_process.join)
+        print('')
+    except BaseException:
+        aggregator_process.terminate()
+        for p in counter_processes:
+            p.terminate()
+        raise
+    await run_blocking(join_local_partials, prepared_txt, prepared_ids, heldout_txt, vocabulary_txt)
+
+
+async def prepare_distributed(coordinator, unprepared_txt, prepared_txt, prepared_ids, heldout_txt,
+                              vocabulary_txt, characters_txt):
+    chunk_count = max(1, math.ceil(os.path.getsize(unprepared_txt) / ARGS.chunk_size))
+    announce('Preparing {} chunks of "{}" with {} local workers (coordinated through "{}")...'
+             .format(chunk_count, unprepared_txt, ARGS.workers, coordinator.directory))
+    chunk_processes = list(map(lambda index: Process(target=prepare_chunks,
+                                                     args=(coordinator.directory, unprepared_txt, chunk_count)),
+                               range(ARGS.workers)))
+    try:
+        for p in chunk_processes:
+            p.start()
+        for p in chunk_processes:
+            await run_blocking(p.join)
+        if any(p.exitcode != 0 for p in chunk_processes):
+            raise RuntimeError('Preparation got interrupted')
+    except BaseException:
+        for p in chunk_processes:
+            p.terminate()
+        raise
+    await run_blocking(coordinator.run_once, 'merge', partial(merge_chunks, coordinator, chunk_count,
+                                                              prepared_txt, prepared_ids, heldout_txt,
+                                                              vocabulary_txt, characters_txt))
+    return chunk_count
+
+
+def read_vocabulary(vocabulary_txt, characters_txt):
+    words = set()
+    with open(vocabulary_txt) as vocabulary_file:
+        for line in vocabulary_file:
+            for word in line.split():
+                words.add(word.encode())
+    announce("{} unique words read from vocabulary file.".format(len(words)))
+    if os.path.isfile(characters_txt):
+        use_utf8 = read_use_utf8(characters_txt, ARGS.utf8_threshold)
+    else:
+        # Model directories prepared before character reports were introduced
+        use_utf8 = all(len(word.decode()) == 1 for word in words)
+        announce(
+            "{} like a character based model.".format(
+                "Looks" if use_utf8 else "Doesn't look"
+            )
+        )
+    return words, use_utf8
+
+
+def build_scorer(lm_binary, kenlm_scorer, words, auto_use_utf8):
+    if ARGS.alphabet_mode == 'auto':
+        use_utf8 = auto_use_utf8
+    elif ARGS.alphabet_mode == 'utf8':
+        use_utf8 = True
+    else:
+        use_utf8 = False
+    serialized_alphabet = get_serialized_utf8_alphabet() if use_utf8 else LANG.get_serialized_alphabet()
+    from ds_ctcdecoder import Scorer, Alphabet
+    alphabet = Alphabet()
+    err = alphabet.deserialize(serialized_alphabet, len(serialized_alphabet))
+    if err != 0:
+        announce('Error loading alphabet: {}'.format(err))
+        sys.exit(1)
+    scorer = Scorer()
+    scorer.set_alphabet(alphabet)
+    scorer.set_utf8_mode(use_utf8)
+    scorer.reset_params(LANG.alpha, LANG.beta)
+    scorer.load_lm(lm_binary)
+    scorer.fill_dictionary(list(words))
+    shutil.copy(lm_binary, kenlm_scorer)
+    scorer.save_dictionary(kenlm_scorer, True)  # append, not overwrite
+    announce('Package created in {}'.format(kenlm_scorer))
+    announce('Testing package...')
+    scorer = Scorer()
+    scorer.load_lm(kenlm_scorer)
+
+
 def main():
     alphabet_txt = os.path.join(LANG.model_dir, 'alphabet.txt')
     raw_txt_gz = os.path.join(LANG.model_dir, 'raw.txt.gz')
     unprepared_txt = os.path.join(LANG.model_dir, 'unprepared.txt')
     prepared_txt = os.path.join(LANG.model_dir, 'prepared.txt')
+    prepared_ids = os.path.join(LANG.model_dir, 'prepared.ids')
+    heldout_txt = os.path.join(LANG.model_dir, 'heldout.txt')
     vocabulary_txt = os.path.join(LANG.model_dir, 'vocabulary.txt')
+    characters_txt = os.path.join(LANG.model_dir, 'characters.txt')
+    preparation_txt = os.path.join(LANG.model_dir, 'preparation.txt')
     unfiltered_arpa = os.path.join(LANG.model_dir, 'unfiltered.arpa')
     filtered_arpa = os.path.join(LANG.model_dir, 'filtered.arpa')
     lm_binary = os.path.join(LANG.model_dir, 'lm.binary')
     kenlm_scorer = os.path.join(LANG.model_dir, 'kenlm.scorer')
+    evaluation_txt = os.path.join(LANG.model_dir, 'evaluation.txt')
     temp_prefix = os.path.join(LANG.model_dir, 'tmp')
+    vocabulary = {}
+    coordinator = None
+    if ARGS.distributed is not None:
+        coordinator = Coordinator(os.path.join(LANG.model_dir, 'distributed-' + ARGS.distributed),
+                                  lease_timeout=ARGS.lease_timeout)
+        check_settings(coordinator)
 
-    section('Writing alphabet file', empty_lines_before=1)
-    with open(alphabet_txt, 'w', encoding='utf-8') as alphabet_file:
-        alphabet_file.write('\n'.join(LANG.alphabet) + '\n')
-
-    redo = ARGS.force_download
-
-    section('Downloading text data')
-    redo = maybe_download(LANG.text_url, raw_txt_gz, force=redo)
-
-    section('Unzipping text data')
-    redo = maybe_ungzip(raw_txt_gz, unprepared_txt, force=redo)
-
-    redo = redo or ARGS.force_prepare
-
-    section('Preparing text and building vocabulary')
-    if redo or not os.path.isfile(prepared_txt) or not os.path.isfile(vocabulary_txt):
-        redo = True
-        announce('Preparing {} shards of "{}"...'.format(ARGS.workers, unprepared_txt))
-        counters = Queue(ARGS.workers)
-        source_bytes = os.path.getsize(unprepared_txt)
-        aggregator_process = Process(target=aggregate_counters, args=(vocabulary_txt, source_bytes, counters))
-        aggregator_process.start()
-        counter_processes = list(map(lambda index: Process(target=count_words, args=(index, counters)),
-                                     range(ARGS.workers)))
-        try:
-            for p in counter_processes:
-                p.start()
-            for p in counter_processes:
-                p.join()
-            counters.put(STOP_TOKEN)
-            aggregator_process.join()
-            print('')
-            partials = list(map(lambda i: get_partial_path(i), range(ARGS.workers)))
-            join_files(partials, prepared_txt)
-            for partial in partials:
-                os.unlink(partial)
-        except KeyboardInterrupt:
-            aggregator_process.terminate()
-            for p in counter_processes:
-                p.terminate()
-            raise
-    else:
-        announce('Files "{}" and \n\t"{}" existing - not preparing'.format(prepared_txt, vocabulary_txt))
-
-    redo = redo or ARGS.force_generate
-
-    section('Building unfiltered language model')
-    if redo or not os.path.isfile(unfiltered_arpa):
-        redo = True
-        lmplz_args = [
-            KENLM_BIN + '/lmplz',
-            '--temp_prefix', temp_prefix,
-            '--memory', '80%',
-            '--discount_fallback',
-            '--limit_vocab_file', vocabulary_txt,
-            '--text', prepared_txt,
-            '--arpa', unfiltered_arpa,
-            '--skip', 'symbols',
-            '--order', str(LANG.order)
-        ]
-        if len(LANG.prune) > 0:
-            lmplz_args.append('--prune')
-            lmplz_args.extend(list(map(str, LANG.prune)))
-        subprocess.check_call(lmplz_args)
-    else:
+    def run_once(name, func, *args):
+        # In distributed mode only one node runs func - all others wait for it and take over its result
+        if coordinator is None:
+            return func(*args)
+        return coordinator.run_once(name, partial(func, *args))
+
+    async def write_alphabet(redo):
+        with open(alphabet_txt, 'w', encoding='utf-8') as alphabet_file:
+            alphabet_file.write('\n'.join(LANG.alphabet) + '\n')
+        return False
+
+    async def download_text(redo):
+        return await run_blocking(run_once, 'download',
+                                  maybe_download, LANG.text_url, raw_txt_gz, redo or ARGS.force_download)
+
+    async def unzip_text(redo):
+        return await run_blocking(run_once, 'unzip', maybe_ungzip, raw_txt_gz, unprepared_txt, redo)
+
+    def get_preparation_mismatches():
+        if os.path.isfile(preparation_txt):
+            recorded = read_settings(preparation_txt)
+        elif os.path.isfile(heldout_txt):
+            # Held-out text prepared without recording its settings
+            recorded = {}
+        else:
+            # Text prepared before held-out text was supported
+            recorded = {'heldout_every': '0'}
+        mismatches = get_setting_mismatches(recorded, PREPARATION_SETTINGS)
+        for name in mismatches:
+            announce('Setting "{}" is {} - text got prepared with {}'.format(name, getattr(ARGS, name),
+                                                                             recorded.get(name, 'unknown')))
+        return mismatches
+
+    async def prepare_text(redo):
+        redo = redo or ARGS.force_prepare
+        chunk_count = None
+        # In distributed mode, files of the models directory could still be in the making by another node
+        if redo or (coordinator is not None and not coordinator.is_done('merge')) or \
+                not os.path.isfile(prepared_txt) or not os.path.isfile(vocabulary_txt) or \
+                (ARGS.token_ids and not os.path.isfile(prepared_ids)) or \
+                (ARGS.heldout_every > 0 and not os.path.isfile(heldout_txt)) or \
+                len(get_preparation_mismatches()) > 0:
+            redo = True
+            if coordinator is None:
+                await prepare(unprepared_txt, prepared_txt, prepared_ids, heldout_txt, vocabulary_txt, characters_txt)
+            else:
+                chunk_count = await prepare_distributed(coordinator, unprepared_txt, prepared_txt, prepared_ids,
+                                                        heldout_txt, vocabulary_txt, characters_txt)
+            write_settings(preparation_txt, PREPARATION_SETTINGS)
+        else:
+            announce('Files "{}" and \n\t"{}" existing - not preparing'.format(prepared_txt, vocabulary_txt))
+        if coordinator is not None:
+            # Only one of the nodes continues with the rest of the pipeline
+            if coordinator.is_done(PIPELINE):
+                raise PipelineStopped('Distributed run "{}" already completed'.format(ARGS.distributed))
+            if not coordinator.try_claim(PIPELINE):
+                raise PipelineStopped('Preparation finished - continuing on another node')
+            if chunk_count is not None:
+                await run_blocking(remove_chunk_files, coordinator, chunk_count)
+        return redo
+
+    async def build_unfiltered_lm(redo):
+        redo = redo or ARGS.force_generate
+        if redo or not os.path.isfile(unfiltered_arpa):
+            lmplz_args = [
+                KENLM_BIN + '/lmplz',
+                '--temp_prefix', temp_prefix,
+                '--memory', '80%',
+                '--discount_fallback',
+                '--limit_vocab_file', vocabulary_txt,
+                '--text', prepared_txt,
+                '--arpa', unfiltered_arpa,
+                '--skip', 'symbols',
+                '--order', str(LANG.order)
+            ]
+            if len(LANG.prune) > 0:
+                lmplz_args.append('--prune')
+                lmplz_args.extend(list(map(str, LANG.prune)))
+            await check_call(lmplz_args)
+            return True
         announce('File "{}" existing - not generating'.format(unfiltered_arpa))
+        return False
 
-    section('Filtering language model')
-    if redo or not os.path.isfile(filtered_arpa):
-        redo = True
-        with open(vocabulary_txt, 'rb') as vocabulary_file:
-            vocabulary_content = vocabulary_file.read()
-        subprocess.run([
-            KENLM_BIN + '/filter',
-            'single',
-            'model:' + unfiltered_arpa,
-            filtered_arpa
-        ], input=vocabulary_content, check=True)
-    else:
+    async def filter_lm(redo):
+        if redo or not os.path.isfile(filtered_arpa):
+            with open(vocabulary_txt, 'rb') as vocabulary_file:
+                vocabulary_content = vocabulary_file.read()
+            await check_call([
+                KENLM_BIN + '/filter',
+                'single',
+                'model:' + unfiltered_arpa,
+                filtered_arpa
+            ], input=vocabulary_content)
+            return True
         announce('File "{}" existing - not filtering'.format(filtered_arpa))
+        return False
 
-    section('Generating binary representation')
-    if redo or not os.path.isfile(lm_binary):
-        redo = True
-        subprocess.check_call([
-            KENLM_BIN + '/build_binary',
-            '-a', '255',
-            '-q', '8',
-            '-v',
-            'trie',
-            filtered_arpa,
-            lm_binary
-        ])
-    else:
+    async def build_binary(redo):
+        if redo or not os.path.isfile(lm_binary):
+            await check_call([
+                KENLM_BIN + '/build_binary',
+                '-a', '255',
+                '-q', '8',
+                '-v',
+                'trie',
+                filtered_arpa,
+                lm_binary
+            ])
+            return True
         announce('File "{}" existing - not generating'.format(lm_binary))
+        return False
 
-    section('Building scorer')
-    if redo or not os.path.isfile(kenlm_scorer):
-        redo = True
-        words = set()
-        vocab_looks_char_based = True
-        with open(vocabulary_txt) as vocabulary_file:
-            for line in vocabulary_file:
-                for word in line.split():
-                    words.add(word.encode())
-                    if len(word) > 1:
-                        vocab_looks_char_based = False
-        announce("{} unique words read from vocabulary file.".format(len(words)))
-        announce(
-            "{} like a character based model.".format(
-                "Looks" if vocab_looks_char_based else "Doesn't look"
-            )
-        )
-        if ARGS.alphabet_mode == 'auto':
-            use_utf8 = vocab_looks_char_based
-        elif ARGS.alphabet_mode == 'utf8':
-            use_utf8 = True
-        else:
-            use_utf8 = False
-        serialized_alphabet = get_serialized_utf8_alphabet() if use_utf8 else LANG.get_serialized_alphabet()
-        from ds_ctcdecoder import Scorer, Alphabet
-        alphabet = Alphabet()
-        err = alphabet.deserialize(serialized_alphabet, len(serialized_alphabet))
-        if err != 0:
-            announce('Error loading alphabet: {}'.format(err))
-            sys.exit(1)
-        scorer = Scorer()
-        scorer.set_alphabet(alphabet)
-        scorer.set_utf8_mode(use_utf8)
-        scorer.reset_params(LANG.alpha, LANG.beta)
-        scorer.load_lm(lm_binary)
-        scorer.fill_dictionary(list(words))
-        shutil.copy(lm_binary, kenlm_scorer)
-        scorer.save_dictionary(kenlm_scorer, True)  # append, not overwrite
-        announce('Package created in {}'.format(kenlm_scorer))
-        announce('Testing package...')
-        scorer = Scorer()
-        scorer.load_lm(kenlm_scorer)
-    else:
+    async def load_vocabulary(redo):
+        # Runs concurrently to LM generation, so that the scorer can be built right after it
+        if redo or ARGS.force_generate or not os.path.isfile(kenlm_scorer):
+            vocabulary['words'], vocabulary['use_utf8'] = await run_blocking(read_vocabulary, vocabulary_txt, characters_txt)
+        return redo
+
+    async def package_scorer(redo):
+        if redo or not os.path.isfile(kenlm_scorer):
+            if 'words' not in vocabulary:
+                vocabulary['words'], vocabulary['use_utf8'] = await run_blocking(read_vocabulary, vocabulary_txt, characters_txt)
+            await run_blocking(build_scorer, lm_binary, kenlm_scorer, vocabulary['words'], vocabulary['use_utf8'])
+            return True
         announce('File "{}" existing - not building'.format(kenlm_scorer))
+        return False
+
+    async def evaluate_lm(redo):
+        if ARGS.heldout_every <= 0:
+            announce('No held-out data (see --heldout-every) - not evaluating')
+            return False
+        if redo or not os.path.isfile(evaluation_txt):
+            # Evaluating in a separate process, as its process pool must not get forked from an executor thread
+            eval_args = [
+                sys.executable, EVALUATE_PY,
+                lm_binary, heldout_txt, evaluation_txt,
+                '--workers', str(ARGS.workers),
+                '--batch-size', str(ARGS.eval_batch_size)
+            ]
+            if ARGS.eval_lines is not None:
+                eval_args.extend(['--max-lines', str(ARGS.eval_lines)])
+            await check_call(eval_args)
+            return True
+        announce('File "{}" existing - not evaluating'.format(evaluation_txt))
+        return False
+
+    alphabet_stage = Stage('Writing alphabet file', write_alphabet)
+    download_stage = Stage('Downloading text data', download_text)
+    unzip_stage = Stage('Unzipping text data', unzip_text, depends_on=[download_stage])
+    prepare_stage = Stage('Preparing text and building vocabulary', prepare_text, depends_on=[unzip_stage])
+    unfiltered_stage = Stage('Building unfiltered language model', build_unfiltered_lm, depends_on=[prepare_stage])
+    filter_stage = Stage('Filtering language model', filter_lm, depends_on=[unfiltered_stage])
+    binary_stage = Stage('Generating binary representation', build_binary, depends_on=[filter_stage])
+    vocabulary_stage = Stage('Reading vocabulary', load_vocabulary, depends_on=[prepare_stage])
+    scorer_stage = Stage('Building scorer', package_scorer, depends_on=[binary_stage, vocabulary_stage])
+    evaluate_stage = Stage('Evaluating language model', evaluate_lm, depends_on=[binary_stage, prepare_stage])
+    run_stages([
+        alphabet_stage,
+        download_stage,
+        unzip_stage,
+        prepare_stage,
+        unfiltered_stage,
+        filter_stage,
+        binary_stage,
+        vocabulary_stage,
+        scorer_stage,
+        evaluate_stage
+    ])
+    if coordinator is not None and coordinator.holds(PIPELINE):
+        coordinator.complete(PIPELINE)
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Generate language models from OSCAR corpora', prog='genlm')
     parser.add_argument('language', choices=LANGUAGE_CODES,
                         help='language of the model to generate')
@@ -252,6 +625,28 @@ def parse_args():
                         help='final number of words in vocabulary')
     parser.add_argument('--keep-factor', type=int, default=10,
                         help='times --vocabulary-size of entries to keep after pruning in each vocabulary aggregator')
+    parser.add_argument('--compact-counting', action='store_true',
+                        help='counts words of each worker in a compact table - reduces worker memory to about '
+                             'a half, but counting takes about 2.5 times as long (see bench_counting.py)')
+    parser.add_argument('--token-ids', action='store_true',
+                        help='additionally stores the prepared text as vocabulary-mapped token IDs (prepared.ids) - '
+                             'workers keep their word IDs only until they flush their counts, but merging keeps '
+                             'the IDs of all distinct words of the text in memory')
+    parser.add_argument('--distributed', type=str, default=None, metavar='RUN_ID',
+                        help='prepares text together with all other genlm processes using the same run ID and '
+                             'the same models directory (e.g. on other nodes) - afterwards only one of them continues; '
+                             'use a new run ID for every run')
+    parser.add_argument('--chunk-size', type=str, default='256M',
+                        help='size of the text chunks that get claimed by nodes and workers in distributed mode')
+    parser.add_argument('--lease-timeout', type=int, default=600,
+                        help='seconds after which a chunk claimed by a silent node gets taken over in distributed mode')
+    parser.add_argument('--heldout-every', type=int, default=0,
+                        help='moves about every n-th prepared line (selected by checksum) into held-out data '
+                             '(heldout.txt) for evaluation - 0 disables held-out data and evaluation')
+    parser.add_argument('--eval-lines', type=int, default=None,
+                        help='maximum number of held-out lines to evaluate (all by default)')
+    parser.add_argument('--eval-batch-size', type=int, default=1000,
+                        help='number of held-out lines per evaluation batch')
     parser.add_argument('--order', type=int,
                         help='overrides language-specific KenLM order')
     parser.add_argument('--prune', type=str,
@@ -261,16 +656,23 @@ def parse_args():
     parser.add_argument('--beta', type=float, default=None,
                         help='overrides language-specific beta parameter')
     parser.add_argument('--alphabet-mode', choices=['auto', 'utf8', 'specific'], default='auto',
-                        help='if alphabet-mode should be determined from the vocabulary (auto), '
+                        help='if alphabet-mode should be determined from the characters the language\'s alphabet '
+                             'dropped during preparation (auto - see characters.txt and --utf8-threshold), '
                              'or the alphabet should be all utf-8 characters (utf8), '
                              'or the alphabet should be language specific (specific)')
+    parser.add_argument('--utf8-threshold', type=float, default=DEFAULT_UTF8_THRESHOLD,
+                        help='share of characters that the language\'s alphabet has to drop for auto alphabet-mode '
+                             'to use an utf-8 alphabet')
     parser.add_argument('--force-download', action='store_true',
                         help='forces downloading, preparing and generating from scratch')
     parser.add_argument('--force-prepare', action='store_true',
                         help='forces preparing and generating from scratch (reusing available download)')
     parser.add_argument('--force-generate', action='store_true',
                         help='forces generating from scratch (reusing prepared data)')
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    args.block_size = parse_file_size(args.block_size)
+    args.chunk_size = parse_file_size(args.chunk_size)
+    return args
 
 
 if __name__ == '__main__':
@@ -284,7 +686,6 @@ if __name__ == '__main__':
         LANG.alpha = ARGS.alpha
     if ARGS.beta is not None:
         LANG.beta = ARGS.beta
-    ARGS.block_size = parse_file_size(ARGS.block_size)
     try:
         main()
     except KeyboardInterrupt:
@@ -50,7 +50,7 @@ class LanguageBase:
         line = line.translate(self.pre_filter)
         return line.lower().strip()
 
-    def clean(self, line):
+    def clean(self, line, stats=None):
         line = self.pre_clean(line)
         if len(line) == 0:
             return []
@@ -60,14 +60,21 @@ class LanguageBase:
                     return []
             else:
                 line = pattern.sub(replacement, line)
+        if stats is not None:
+            stats.total += len(line)
         chars = []
         for c in line:
-            if self.simplify and c not in self.alphabet:
-                c = unicodedata.normalize("NFKD", c).encode("ascii", "ignore").decode("ascii", "ignore")
-            for sc in c:
-                if sc not in self.alphabet:
-                    continue
-                chars.append(sc)
+            if c in self.alphabet:
+                chars.append(c)
+                continue
+            # Characters outside of the alphabet are either simplified to alphabet characters or dropped
+            kept = len(chars)
+            if self.simplify:
+                for sc in unicodedata.normalize("NFKD", c).encode("ascii", "ignore").decode("ascii", "ignore"):
+                    if sc in self.alphabet:
+                        chars.append(sc)
+            if stats is not None:
+                (stats.simplified if len(chars) > kept else stats.dropped)[c] += 1
         return [''.join(chars)]
 
 
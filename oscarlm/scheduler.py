@@ -0,0 +1,80 @@
+import time
+import asyncio
+import subprocess
+
+from utils import announce, section, secs_to_hours
+
+
+class PipelineStopped(Exception):
+    # Raised by a stage to end the pipeline regularly without running the remaining stages
+    pass
+
+
+class Stage:
+    def __init__(self, name, run, depends_on=()):
+        # run is a coroutine function that gets passed if any dependency (re)generated its output
+        # and returns if the stage itself (re)generated its output
+        self.name = name
+        self.run = run
+        self.depends_on = list(depends_on)
+        self.redone = None
+        self.duration = None
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def check_call(args, input=None):
+    process = await asyncio.create_subprocess_exec(*args, stdin=None if input is None else subprocess.PIPE)
+    await process.communicate(input=input)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+
+
+async def _run_stage(stage, tasks):
+    dependency_results = await asyncio.gather(*map(lambda dependency: tasks[dependency], stage.depends_on))
+    section(stage.name)
+    start = time.time()
+    stage.redone = await stage.run(any(dependency_results))
+    stage.duration = time.time() - start
+    announce('Stage "{}" finished (elapsed: {})'.format(stage.name, secs_to_hours(stage.duration)))
+    return stage.redone
+
+
+async def _run_stages(stages):
+    tasks = {}
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in tasks:
+                raise ValueError('Stage "{}" has to be listed after its dependency "{}"'
+                                 .format(stage.name, dependency.name))
+        tasks[stage] = asyncio.ensure_future(_run_stage(stage, tasks))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+def run_stages(stages):
+    start = time.time()
+    # No asyncio.run(), as the project still targets Python 3.6
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_run_stages(stages))
+    except PipelineStopped as stop:
+        announce(str(stop))
+    finally:
+        # Does not wait for executor threads that are still blocked (e.g. after an interrupt)
+        loop.close()
+        section('Stage timings')
+        for stage in stages:
+            if stage.duration is None:
+                state = 'not finished'
+            else:
+                state = '{} ({})'.format(secs_to_hours(stage.duration), 'new output' if stage.redone else 'output kept')
+            announce('{:<50} {}'.format(stage.name, state))
+        announce('{:<50} {}'.format('Overall', secs_to_hours(time.time() - start)))
@@ -9,12 +9,11 @@ import sys
 import os
 import errno
 import stat
-import gzip
-
-import six.moves.urllib as urllib
 
 from pkg_resources import parse_version
 
+from artifacts import CACHE_DIR, ArtifactCache, download_artifact
+
 
 DEFAULT_SCHEMES = {
     'deepspeech': 'https://community-tc.services.mozilla.com/api/index/v1/task/project.deepspeech.deepspeech.native_client.%(branch_name)s.%(arch_string)s/artifacts/public/%(artifact_name)s',
@@ -32,15 +31,7 @@ def get_tc_url(arch_string, artifact_name='native_client.tar.xz', branch_name='m
 
     return TASKCLUSTER_SCHEME % { 'arch_string': arch_string, 'artifact_name': artifact_name, 'branch_name': branch_name}
 
-def maybe_download_tc(target_dir, tc_url, progress=True):
-    def report_progress(count, block_size, total_size):
-        percent = (count * block_size * 100) // total_size
-        sys.stdout.write("\rDownloading: %d%%" % percent)
-        sys.stdout.flush()
-
-        if percent >= 100:
-            print('\n')
-
+def maybe_download_tc(target_dir, tc_url, progress=True, cache_dir=CACHE_DIR, sha256=None):
     assert target_dir is not None
 
     target_dir = os.path.abspath(target_dir)
@@ -53,20 +44,14 @@ def maybe_download_tc(target_dir, tc_url, progress=True):
 
     tc_filename = os.path.basename(tc_url)
     target_file = os.path.join(target_dir, tc_filename)
-    is_gzip = False
     if not os.path.isfile(target_file):
-        print('Downloading %s ...' % tc_url)
-        _, headers = urllib.request.urlretrieve(tc_url, target_file, reporthook=(report_progress if progress else None))
-        is_gzip = headers.get('Content-Encoding') == 'gzip'
+        if cache_dir:
+            ArtifactCache(cache_dir).export(tc_url, target_file, progress=progress, expected_sha256=sha256)
+        else:
+            print('Downloading %s ...' % tc_url, file=sys.stderr)
+            download_artifact(tc_url, target_file, progress=progress, expected_sha256=sha256)
     else:
-        print('File already exists: %s' % target_file)
-
-    if is_gzip:
-        with open(target_file, "r+b") as frw:
-            decompressed = gzip.decompress(frw.read())
-            frw.seek(0)
-            frw.write(decompressed)
-            frw.truncate()
+        print('File already exists: %s' % target_file, file=sys.stderr)
 
     return target_file
 
@@ -92,7 +77,11 @@ def main():
     parser.add_argument('--branch', required=False,
                         help='Branch name to use. Defaulting to current content of VERSION file.')
     parser.add_argument('--decoder', action='store_true',
-                        help='Get URL to ds_ctcdecoder Python package.')
+                        help='Get URL to ds_ctcdecoder Python package. If --target is also passed, the package gets downloaded there and its local path is printed instead.')
+    parser.add_argument('--cache', required=False, default=CACHE_DIR,
+                        help='Directory of a (shared) artifact cache to resolve artifacts from before downloading them. Defaults to environment variable TC_CACHE_DIR.')
+    parser.add_argument('--sha256', required=False,
+                        help='Expected SHA-256 of the artifact. Without it, cached artifacts are only used while the server reports them unchanged (ETag/Last-Modified).')
 
     args = parser.parse_args()
 
@@ -143,7 +132,11 @@ def main():
 
         ctc_arch = args.arch + '-ctc'
 
-        print(get_tc_url(ctc_arch, artifact, args.branch))
+        if args.target:
+            print(maybe_download_tc(target_dir=args.target, tc_url=get_tc_url(ctc_arch, artifact, args.branch),
+                                    cache_dir=args.cache, sha256=args.sha256))
+        else:
+            print(get_tc_url(ctc_arch, artifact, args.branch))
         exit(0)
 
     if args.source is not None:
@@ -154,7 +147,8 @@ def main():
             print('No such scheme: %s' % args.source)
             exit(1)
 
-    maybe_download_tc(target_dir=args.target, tc_url=get_tc_url(args.arch, args.artifact, args.branch))
+    maybe_download_tc(target_dir=args.target, tc_url=get_tc_url(args.arch, args.artifact, args.branch),
+                      cache_dir=args.cache, sha256=args.sha256)
 
     if args.artifact == "convert_graphdef_memmapped_format":
         convert_graph_file = os.path.join(args.target, args.artifact)
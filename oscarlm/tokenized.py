@@ -0,0 +1,247 @@
+import os
+import sys
+import mmap
+import argparse
+from array import array
+from itertools import islice
+
+from utils import MEGABYTE, announce, log_progress
+
+# Token IDs are stored as uint32 and line offsets (in tokens) as uint64, both in native byte order.
+# IDs below the vocabulary size refer to vocabulary.txt entries in the same order,
+# all other words seen in the corpus get IDs above it.
+# Partial files (written by TokenWriter) use a sequence of local ID tables instead, so that no worker has to keep
+# the IDs of all words it ever saw. Their tables file lists (first token offset, first word) of every table.
+ID_TYPE = 'I'
+OFFSET_TYPE = 'Q'
+INDEX_SUFFIX = '.index'
+WORDS_SUFFIX = '.words'
+TABLES_SUFFIX = '.tables'
+INDEX_FLUSH_SIZE = 1 << 16
+
+
+def get_index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def get_words_path(path):
+    return path + WORDS_SUFFIX
+
+
+def get_tables_path(path):
+    return path + TABLES_SUFFIX
+
+
+def read_words(path):
+    with open(get_words_path(path), encoding='utf-8') as words_file:
+        vocabulary_size = int(words_file.readline())
+        return vocabulary_size, words_file.read().split('\n')[:-1]
+
+
+def write_words(path, words, vocabulary_size):
+    with open(get_words_path(path), 'w', encoding='utf-8') as words_file:
+        words_file.write('{}\n'.format(vocabulary_size))
+        for word in words:
+            words_file.write(word + '\n')
+
+
+class TokenWriter:
+    def __init__(self, path, buffering=-1):
+        self.path = path
+        self.ids = {}
+        self.offset = 0
+        self.word_count = 0
+        self.index = array(OFFSET_TYPE, [0])
+        self.tables = array(OFFSET_TYPE, [0, 0])
+        self.id_file = open(path, 'wb', buffering=buffering)
+        self.index_file = open(get_index_path(path), 'wb', buffering=buffering)
+        self.words_file = open(get_words_path(path), 'w', encoding='utf-8', buffering=buffering)
+        # Partial files are not vocabulary-mapped yet - all their IDs count as out-of-vocabulary
+        self.words_file.write('0\n')
+
+    def write_line(self, words):
+        line_ids = array(ID_TYPE)
+        for word in words:
+            word_id = self.ids.get(word)
+            if word_id is None:
+                word_id = self.ids[word] = len(self.ids)
+            line_ids.append(word_id)
+        line_ids.tofile(self.id_file)
+        self.offset += len(line_ids)
+        self.index.append(self.offset)
+        if len(self.index) >= INDEX_FLUSH_SIZE:
+            self.index.tofile(self.index_file)
+            self.index = array(OFFSET_TYPE)
+
+    def _write_ids(self):
+        for word in self.ids:
+            self.words_file.write(word + '\n')
+        self.word_count += len(self.ids)
+        self.ids = {}
+
+    def flush_ids(self):
+        """Writes out the current ID table and starts a new one for all following lines"""
+        if len(self.ids) == 0:
+            return
+        self._write_ids()
+        self.tables.extend([self.offset, self.word_count])
+
+    def close(self):
+        self._write_ids()
+        self.words_file.close()
+        self.index.tofile(self.index_file)
+        self.index_file.close()
+        self.id_file.close()
+        with open(get_tables_path(self.path), 'wb') as tables_file:
+            self.tables.tofile(tables_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_arrays(path, typecode, block_size):
+    with open(path, 'rb') as from_file:
+        while True:
+            block = from_file.read(block_size)
+            if len(block) == 0:
+                return
+            yield array(typecode, block)
+
+
+def merge_token_partials(from_paths, vocabulary_txt, to_path, block_size=1 * MEGABYTE):
+    with open(vocabulary_txt, encoding='utf-8') as vocabulary_file:
+        words = [line.rstrip('\n') for line in vocabulary_file]
+    global_ids = {word: word_id for word_id, word in enumerate(words)}
+    vocabulary_size = len(words)
+    total_size = sum(map(lambda p: os.path.getsize(p) + os.path.getsize(get_index_path(p)), from_paths))
+    # Block sizes have to stay multiples of the item sizes, so that blocks can be mapped independently
+    id_size = array(ID_TYPE).itemsize
+    id_block_size = block_size - block_size % id_size
+    offset_block_size = block_size - block_size % array(OFFSET_TYPE).itemsize
+    announce('Merging {} token ID files to "{}"...'.format(len(from_paths), to_path))
+    progress_indicator = log_progress(total=total_size, format='bytes')
+    base = 0
+    with open(to_path, 'wb') as id_file, open(get_index_path(to_path), 'wb') as index_file:
+        array(OFFSET_TYPE, [0]).tofile(index_file)
+        for from_path in from_paths:
+            with open(get_tables_path(from_path), 'rb') as tables_file:
+                tables = array(OFFSET_TYPE, tables_file.read())
+            # Appending the end of the file as a last table start gives every table its bounds
+            tables.extend([os.path.getsize(from_path) // id_size, 0])
+            with open(from_path, 'rb') as from_file, open(get_words_path(from_path), encoding='utf-8') as words_file:
+                words_file.readline()
+                for table_index in range(0, len(tables) - 2, 2):
+                    token_start, word_start, token_end, word_end = tables[table_index:table_index + 4]
+                    local_words = words_file if table_index + 4 == len(tables) else \
+                        islice(words_file, word_end - word_start)
+                    table = array(ID_TYPE)
+                    for word in local_words:
+                        word = word[:-1]
+                        word_id = global_ids.get(word)
+                        if word_id is None:
+                            word_id = global_ids[word] = len(words)
+                            words.append(word)
+                        table.append(word_id)
+                    remaining = (token_end - token_start) * id_size
+                    while remaining > 0:
+                        block = array(ID_TYPE, from_file.read(min(id_block_size, remaining)))
+                        remaining -= len(block) * block.itemsize
+                        array(ID_TYPE, map(table.__getitem__, block)).tofile(id_file)
+                        progress_indicator.increment(value_difference=len(block) * block.itemsize)
+            first = True
+            last_offset = 0
+            for block in _read_arrays(get_index_path(from_path), OFFSET_TYPE, offset_block_size):
+                progress_indicator.increment(value_difference=len(block) * block.itemsize)
+                if first:
+                    # Every partial index starts with its own zero offset
+                    first = False
+                    block = block[1:]
+                if len(block) > 0:
+                    last_offset = block[-1]
+                    array(OFFSET_TYPE, map(lambda offset: offset + base, block)).tofile(index_file)
+            base += last_offset
+    progress_indicator.end()
+    write_words(to_path, words, vocabulary_size)
+
+
+class TokenCorpus:
+    def __init__(self, path):
+        self.path = path
+        self.vocabulary_size, self.words = read_words(path)
+        self._maps = []
+        self.ids = self._map_array(path, ID_TYPE)
+        self.index = self._map_array(get_index_path(path), OFFSET_TYPE)
+
+    def _map_array(self, path, typecode):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(array(typecode))
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped).cast(typecode)
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, line_index):
+        # Returns a view of the line's token IDs - use .tolist() for a copy that is independent of the corpus
+        return self.ids[self.index[line_index]:self.index[line_index + 1]]
+
+    def __iter__(self):
+        return self.iter_lines()
+
+    def iter_lines(self, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        for line_index in range(start, end):
+            yield self.ids[self.index[line_index]:self.index[line_index + 1]]
+
+    def iter_text(self, start=0, end=None):
+        words = self.words
+        for line_ids in self.iter_lines(start=start, end=end):
+            yield ' '.join(map(words.__getitem__, line_ids))
+
+    def is_oov(self, word_id):
+        return word_id >= self.vocabulary_size
+
+    def close(self):
+        self.ids.release()
+        self.index.release()
+        for mapped in self._maps:
+            try:
+                mapped.close()
+            except BufferError:
+                # Line views returned by __getitem__ and iter_lines are zero-copy views of the mapped file -
+                # if some are still referenced, the file gets unmapped as soon as they are released
+                pass
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def export_text(from_path, to_file):
+    with TokenCorpus(from_path) as corpus:
+        for line in log_progress(corpus.iter_text(), total=len(corpus), format=lambda n: '{:.0f} lines'.format(n)):
+            to_file.write(line + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports a token ID corpus as text (e.g. for feeding it to lmplz)')
+    parser.add_argument('corpus', help='path to the token ID file (e.g. models/en/prepared.ids)')
+    parser.add_argument('--output', default='-', help='text file to write to - defaults to stdout')
+    args = parser.parse_args()
+    if args.output == '-':
+        export_text(args.corpus, sys.stdout)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            export_text(args.corpus, output_file)
+
+
+if __name__ == '__main__':
+    main()
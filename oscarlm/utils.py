@@ -9,6 +9,8 @@ import subprocess
 from functools import partial
 from distutils.spawn import find_executable
 
+from artifacts import TEMP_INFIX, get_temp_path
+
 
 KILO = 1024
 KILOBYTE = 1 * KILO
@@ -163,13 +165,25 @@ class log_progress:
         self.end()
 
 
+def remove_temp_file(temp_path):
+    if os.path.isfile(temp_path):
+        os.unlink(temp_path)
+
+
 def download(from_url, to_path, block_size=1 * MEGABYTE):
-    r = requests.get(from_url, stream=True)
-    total_size = int(r.headers.get('content-length', 0))
-    with open(to_path, 'wb') as to_file:
-        announce('Downloading "{}" to "{}"...'.format(from_url, to_path))
-        for block in log_progress(r.iter_content(block_size), total=total_size, format='bytes', value_getter=len):
-            to_file.write(block)
+    # Interrupted downloads must not leave a truncated file that later runs would take as complete
+    temp_path = get_temp_path(to_path)
+    try:
+        r = requests.get(from_url, stream=True)
+        total_size = int(r.headers.get('content-length', 0))
+        with open(temp_path, 'wb') as to_file:
+            announce('Downloading "{}" to "{}"...'.format(from_url, to_path))
+            for block in log_progress(r.iter_content(block_size), total=total_size, format='bytes', value_getter=len):
+                to_file.write(block)
+        os.rename(temp_path, to_path)
+    except BaseException:
+        remove_temp_file(temp_path)
+        raise
 
 
 def maybe_download(from_url, to_path, force=False):
@@ -182,13 +196,22 @@ def maybe_download(from_url, to_path, force=False):
 
 
 def ungzip(from_path, to_path, block_size=1 * MEGABYTE):
+    temp_path = get_temp_path(to_path)
     total_size = os.path.getsize(from_path)
-    with open(from_path, 'rb') as from_file, open(to_path, 'wb') as to_file:
-        gunzip = subprocess.Popen([UNZIP], stdin=subprocess.PIPE, stdout=to_file)
-        announce('Unzipping "{}" to "{}"...'.format(from_path, to_path))
-        blocks = iter(partial(from_file.read, block_size), b'')
-        for block in log_progress(blocks, total=total_size, format='bytes', value_getter=len):
-            gunzip.stdin.write(block)
+    try:
+        with open(from_path, 'rb') as from_file, open(temp_path, 'wb') as to_file:
+            gunzip = subprocess.Popen([UNZIP], stdin=subprocess.PIPE, stdout=to_file)
+            announce('Unzipping "{}" to "{}"...'.format(from_path, to_path))
+            blocks = iter(partial(from_file.read, block_size), b'')
+            for block in log_progress(blocks, total=total_size, format='bytes', value_getter=len):
+                gunzip.stdin.write(block)
+            gunzip.stdin.close()
+            if gunzip.wait() != 0:
+                raise subprocess.CalledProcessError(gunzip.returncode, UNZIP)
+        os.rename(temp_path, to_path)
+    except BaseException:
+        remove_temp_file(temp_path)
+        raise
 
 
 def maybe_ungzip(from_path, to_path, force=False):